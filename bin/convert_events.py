@@ -3,9 +3,11 @@
 
 import socket
 import sys
+import time
 import zmq
 from lxid.utils import events_from_ds
 from lxid.dataset import Cut
+from lxid.parallel import send_arrays
 
 def run_worker(host):
     context = zmq.Context()
@@ -32,23 +34,22 @@ def run_worker(host):
             time.sleep(5)
             continue
 
-    poller = zmq.Poller()
-    poller.register(receiver, zmq.POLLIN)
-    poller.register(controller, zmq.POLLIN)
+    # block on tasks, only checking for a kill signal when idle
+    receiver.setsockopt(zmq.RCVTIMEO, 1000)
 
     while True:
-        socks = dict(poller.poll())
-
-        if socks.get(receiver) == zmq.POLLIN:
+        try:
             task = receiver.recv_pyobj()
-            filename, cut = task
-            print filename
-            r = events_from_ds(filename, cut)
-            sender.send_pyobj(r)
+        except zmq.Again:
+            # everything is treated as a kill signal
+            if controller.poll(0):
+                break
+            continue
 
-        # everything is treated as a kill signal
-        if socks.get(controller) == zmq.POLLIN:
-            break
+        filename, cut = task
+        print filename
+        r = events_from_ds(filename, cut)
+        send_arrays(sender, {'counters': r[0]}, r[1:])
 
 def main(bin_name, host):
     print '%s on %s' % (bin_name, socket.getfqdn())
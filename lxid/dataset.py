@@ -3,11 +3,13 @@
 import os
 import numpy as np
 import h5py
+import hdf5plugin
 
-class Cut(dict):
+class Cut(object):
     '''Cut to be applied to data.
 
-    All cuts are (min_value, max_value) tuples.
+    All cuts are (min_value, max_value) tuples. Cuts are read-only, since
+    apply uses a function compiled from them in __init__.
 
     :param e: Fit energy cut (MeV)
     :param r: Fit radius cut (mm)
@@ -15,20 +17,71 @@ class Cut(dict):
     :param y: Fit Y cut (mm)
     :param z: Fit Z cut (mm)
     '''
+    __slots__ = ('_e', '_r', '_x', '_y', '_z', '_fn')
+
+    e = property(lambda self: self._e)
+    r = property(lambda self: self._r)
+    x = property(lambda self: self._x)
+    y = property(lambda self: self._y)
+    z = property(lambda self: self._z)
+
+    # FitVertex getter for each cut
+    _getters = (
+        ('e', lambda v: v.GetEnergy()),
+        ('r', lambda v: v.GetPosition().Mag()),
+        ('x', lambda v: v.GetPosition().X()),
+        ('y', lambda v: v.GetPosition().Y()),
+        ('z', lambda v: v.GetPosition().Z())
+    )
+
+    # columns of an events_from_ds fit array (X Y Z R T E) for each cut
+    _fit_columns = (('x', 0), ('y', 1), ('z', 2), ('r', 3), ('e', 5))
+
     def __init__(self, e=None, r=None, x=None, y=None, z=None):
-        self['e'] = e
-        self['r'] = r
-        self['x'] = x
-        self['y'] = y
-        self['z'] = z
+        self._e = e
+        self._r = r
+        self._x = x
+        self._y = y
+        self._z = z
+        self._fn = self.compile()
+
+    def __getstate__(self):
+        return self.as_tuple()
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __repr__(self):
+        return 'Cut(e=%r, r=%r, x=%r, y=%r, z=%r)' % self.as_tuple()
 
     def as_tuple(self):
         '''Represent the cut as a tuple.
 
-        :returns: (e, r, x, y, z, t, nhits, fitter) tuple, where all but
-                  fitter are (min, max) tuples
+        :returns: (e, r, x, y, z) tuple of (min, max) tuples or None
         '''
-        return (self['e'], self['r'], self['x'], self['y'], self['z'])
+        return (self.e, self.r, self.x, self.y, self.z)
+
+    def compile(self):
+        '''Build a function that applies this cut to a vertex.
+
+        Only the cuts that are set are checked.
+
+        :returns: Function of a RAT.DS.FitVertex, returning True or False
+        '''
+        checks = []
+        for key, getter in self._getters:
+            bounds = getattr(self, key)
+            if bounds is not None:
+                checks.append((getter, bounds[0], bounds[1]))
+
+        def apply(vertex):
+            for getter, lo, hi in checks:
+                value = getter(vertex)
+                if value < lo or value > hi:
+                    return False
+            return True
+
+        return apply
 
     def apply(self, vertex):
         '''Apply this cut.
@@ -37,44 +90,50 @@ class Cut(dict):
         :returns: True or False
         '''
         # we really should catch NoValueErrors thrown by the FitVertex getters
-        if self['e'] is not None:
-            e = vertex.GetEnergy()
-            if e < self['e'][0] or e > self['e'][1]:
-                return False
+        return self._fn(vertex)
 
-        if self['r'] is not None:
-            r = vertex.GetPosition().Mag()
-            if r < self['r'][0] or r > self['r'][1]:
-                return False
+    def mask(self, fit):
+        '''Apply this cut to many events at once.
 
-        if self['x'] is not None:
-            x = vertex.GetPosition().X()
-            if x < self['x'][0] or x > self['x'][1]:
-                return False
+        :param fit: ndarray of shape (nevents, 6), with columns X Y Z R T E
+        :returns: Boolean ndarray of shape (nevents,), True where events pass
+        '''
+        m = np.ones(len(fit), dtype=np.bool_)
+        for key, column in self._fit_columns:
+            bounds = getattr(self, key)
+            if bounds is not None:
+                m &= (fit[:,column] >= bounds[0]) & (fit[:,column] <= bounds[1])
 
-        if self['y'] is not None:
-            y = vertex.GetPosition().Y()
-            if y < self['y'][0] or y > self['y'][1]:
-                return False
+        return m
 
-        if self['z'] is not None:
-            z = vertex.GetPosition().Z()
-            if z < self['z'][0] or z > self['z'][1]:
-                return False
 
-        return True
+def _write_at(h5_col, cursor, values):
+    '''Write values into an HDF5 dataset at cursor.
 
+    If the dataset is too short, its capacity is doubled (or more, if
+    needed), so that appending costs only O(log n) resizes in total.
+    '''
+    end = cursor + len(values)
+    if end > len(h5_col):
+        h5_col.resize((max(end, 2 * len(h5_col)),) + h5_col.shape[1:])
+    h5_col[cursor:end] = values
 
-def create(h5file, name, files, cut=None, parallel=True):
+
+def create(h5file, name, files, cut=None, parallel=True, estimated_events=None):
     '''Create a new dataset from the given files, inside h5file.
 
     :param h5file: HDF5 file to add the dataset to
     :param name: Name of the new dataset
     :param files: List of ROOT file names
     :param cut: Cut to apply to the whole dataset
-    :param parallel: If True, use a cluster to extract ROOT events
+    :param parallel: If True, use a cluster to extract ROOT events. If
+                     'local', use a pool of processes on this machine.
+    :param estimated_events: *optional* Expected number of passing events,
+                             used to preallocate the per-event datasets
     :returns: The newly-created HDF5 group
     '''
+    from utils import PMT_Q_SCALE
+
     if name in list(h5file):
         raise Exception('Group %s already exists!' % name)
 
@@ -83,17 +142,27 @@ def create(h5file, name, files, cut=None, parallel=True):
     h5_ds.attrs['events_triggered'] = 0
     h5_ds.attrs['events_reconstructed'] = 0
     h5_ds.attrs['events_pass'] = 0
-    h5_ds_fit = h5_ds.create_dataset('fit', (1, 6), 'f', chunks=True)  # x y z r t e
+    h5_ds.attrs['n_written'] = 0
+
+    # datasets are allocated ahead of the data and cropped at the end
+    nalloc = estimated_events or 0
+    h5_ds_fit = h5_ds.create_dataset('fit', (nalloc, 6), 'f', maxshape=(None, 6), chunks=(4096, 6))  # x y z r t e
+    h5_ds_event_ptr = h5_ds.create_dataset('event_ptr', (nalloc+1,), 'i8', maxshape=(None,), chunks=(4096,))
     h5_ds_pmt = h5_ds.create_group('pmt')
-    h5_ds_pmt_t = h5_ds_pmt.create_dataset('t', (1, 10000), 'f', chunks=True, compression='lzf')
-    h5_ds_pmt_q = h5_ds_pmt.create_dataset('q', (1, 10000), 'f', chunks=True, compression='lzf')
-    h5_ds_pmt_tres = h5_ds_pmt.create_dataset('tres', (1, 10000), 'f', chunks=True, compression='lzf')
+    blosc = hdf5plugin.Blosc(cname='lz4', clevel=3, shuffle=hdf5plugin.Blosc.SHUFFLE)
+    h5_ds_pmt_id = h5_ds_pmt.create_dataset('id', (0,), 'u2', maxshape=(None,), chunks=(65536,), **blosc)
+    h5_ds_pmt_t = h5_ds_pmt.create_dataset('t', (0,), 'f', maxshape=(None,), chunks=(65536,), **blosc)
+    h5_ds_pmt_q = h5_ds_pmt.create_dataset('q', (0,), 'i2', maxshape=(None,), chunks=(65536,), **blosc)
+    h5_ds_pmt_q.attrs['scale'] = PMT_Q_SCALE  # q = stored value / scale
+    h5_ds_pmt_tres = h5_ds_pmt.create_dataset('tres', (0,), 'f', maxshape=(None,), chunks=(65536,), **blosc)
+
+    h5_ds_pmt_cols = (h5_ds_pmt_id, h5_ds_pmt_t, h5_ds_pmt_q, h5_ds_pmt_tres)
 
     def append_to_h5(event_tuple, ds):
-        '''Resize h5 ds to fit new event data, and append it.'''
-        counters, fit, pmt_t, pmt_q, pmt_tres = event_tuple
-        n, _ = ds['fit'].shape
-        n = 0 if n == 1 else n  # gotta start somewhere
+        '''Append new event data to h5 ds, growing it if needed.'''
+        counters, fit, pmt_id, pmt_t, pmt_q, pmt_tres, event_ptr = event_tuple
+        n = ds.attrs['n_written']
+        nhits = h5_ds_event_ptr[n]
         nvalid = len(fit)
 
         ds.attrs['events_total'] += counters['events_total']
@@ -101,27 +170,39 @@ def create(h5file, name, files, cut=None, parallel=True):
         ds.attrs['events_reconstructed'] += counters['events_reconstructed']
         ds.attrs['events_pass'] += counters['events_pass']
 
-        h5_ds_fit.resize((n+nvalid, 6))
-        h5_ds_fit[-nvalid:] = fit
+        if nvalid == 0:
+            return
 
-        h5_ds_pmt_t.resize((n+nvalid, 10000))
-        h5_ds_pmt_t[-nvalid:] = pmt_t
+        _write_at(h5_ds_fit, n, fit)
 
-        h5_ds_pmt_q.resize((n+nvalid, 10000))
-        h5_ds_pmt_q[-nvalid:] = pmt_q
+        # offsets are relative to the incoming hits, so rebase onto the tail
+        _write_at(h5_ds_event_ptr, n+1, event_ptr[1:] + nhits)
 
-        h5_ds_pmt_tres.resize((n+nvalid, 10000))
-        h5_ds_pmt_tres[-nvalid:] = pmt_tres
+        for h5_col, col in zip(h5_ds_pmt_cols, (pmt_id, pmt_t, pmt_q, pmt_tres)):
+            _write_at(h5_col, nhits, col)
+
+        ds.attrs['n_written'] = n + nvalid
 
     callback = lambda x: append_to_h5(x, h5_ds)
 
-    if parallel:
+    if parallel == 'local':
+        from utils import convert_events_pool
+        convert_events_pool(files, cut, callback=callback)
+    elif parallel:
         from utils import convert_events_parallel
         convert_events_parallel(files, cut, callback=callback)
     else:
         from utils import convert_events
         convert_events(files, cut, callback=callback)
 
+    # crop the datasets to the data actually written
+    n = h5_ds.attrs['n_written']
+    nhits = h5_ds_event_ptr[n]
+    h5_ds_fit.resize((n, 6))
+    h5_ds_event_ptr.resize((n+1,))
+    for h5_col in h5_ds_pmt_cols:
+        h5_col.resize((nhits,))
+
     return h5_ds
 
 
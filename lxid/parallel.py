@@ -2,9 +2,54 @@
 
 import sys
 import time
+import json
+import pickle
 import multiprocessing
+import numpy as np
 import zmq
 
+def send_arrays(socket, header, arrays, flags=0):
+    '''Send a header and a list of arrays as one multipart message.
+
+    The header is sent as JSON, with the dtype and shape of each array added
+    under 'arrays'. The array data follows in one frame per array, sent
+    without pickling or copying.
+
+    :param socket: ZeroMQ socket to send on
+    :param header: dict of JSON-serializable metadata
+    :param arrays: List of ndarrays
+    :param flags: ZeroMQ send flags
+    '''
+    arrays = [np.ascontiguousarray(a) for a in arrays]
+    header = dict(header, arrays=[(a.dtype.str, a.shape) for a in arrays])
+    socket.send_multipart([json.dumps(header).encode('utf-8')] + arrays, flags, copy=False)
+
+
+def recv_arrays(socket, flags=0):
+    '''Receive a message sent with send_arrays.
+
+    The arrays are read-only views on the received message buffers.
+
+    :param socket: ZeroMQ socket to receive on
+    :param flags: ZeroMQ receive flags
+    :returns: (header, arrays) tuple; header is None for a message sent
+              with socket.send_json(None)
+    '''
+    frames = socket.recv_multipart(flags, copy=False)
+    header = json.loads(frames[0].bytes)
+    if header is None:
+        return None, []
+
+    arrays = []
+    for frame, (dtype, shape) in zip(frames[1:], header.pop('arrays')):
+        if len(frame) == 0:
+            arrays.append(np.empty(shape, dtype=dtype))
+        else:
+            arrays.append(np.frombuffer(frame.buffer, dtype=dtype).reshape(shape))
+
+    return header, arrays
+
+
 class Ventilator(multiprocessing.Process):
     '''ZeroMQ ventilator, produces tasks to run in parallel.
 
@@ -32,7 +77,7 @@ class Ventilator(multiprocessing.Process):
         print 'done'
 
         for task in self.tasks:
-            sender.send_pyobj(task)
+            sender.send_pyobj(task, protocol=pickle.HIGHEST_PROTOCOL)
 
         time.sleep(1)
 
@@ -68,8 +113,9 @@ class Sink(multiprocessing.Process):
         tstart = time.time()
 
         for task_nbr in range(self.task_count):
-            s = receiver.recv_pyobj()
-            sink_data.send_pyobj(s)
+            # pass results through as-is, see send_arrays
+            frames = receiver.recv_multipart(copy=False)
+            sink_data.send_multipart(frames, copy=False)
             if task_nbr % 10 == 0:
                 sys.stdout.write(':')
             else:
@@ -78,7 +124,7 @@ class Sink(multiprocessing.Process):
         print
 
         controller.send('KILL')
-        sink_data.send_pyobj(None)
+        sink_data.send_json(None)
 
         tend = time.time()
         print "Sink: Total elapsed time: %d msec" % ((tend-tstart)*1000)
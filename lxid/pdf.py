@@ -1,59 +1,59 @@
 '''Probability distribution functions.'''
 
-import itertools
 import numpy as np
 
 
-def flatten(listOfLists):
-    "Flatten one level of nesting"
-    return itertools.chain.from_iterable(listOfLists)
+def make_pdf(x, y, event_ptr, bins, log=False):
+    '''Make a PDF of a per-hit observable vs. a per-event observable.
 
+    Every hit is paired with the x value of its event, and the histogram is
+    normalized within each x bin.
 
-def intlen(x):
-    try:
-        return len(x)
-    except TypeError:
-        return 0
+    :param x: ndarray of shape (nevents,), e.g. the fit R column
+    :param y: ndarray of shape (nhits,), e.g. the PMT time residuals
+    :param event_ptr: ndarray of shape (nevents+1,) with the hit offsets of
+                      each event, as returned by utils.events_from_ds
+    :param bins: Bins for (x, y), as for numpy.histogramdd
+    :param log: If True, return the log of the PDF (e.g. for likelihoods)
+    :returns: (h, edges) tuple
+    '''
+    assert(len(bins) == 2)
+    assert(len(x) == len(event_ptr) - 1 and len(y) == event_ptr[-1])
 
+    nhits = event_ptr[1:] - event_ptr[:-1]
 
-def make_pdf(data, observables, bins):
-    assert(len(observables) == len(bins))
-
-    # turn something like [1,2], [[1,2,3], [4,5]], [3,4] into
-    # [1,1,3], [1,2,3], [1,3,3], [2,4,4], [2,5,4]
-    # yeah...
-    a = [map(lambda x: x[o], data) for o in observables]
-    b = np.array(list(flatten(map(lambda x: zip(*x), [[np.tile(z[i], max(1, sum(map(intlen, z[:i]+z[i+1:])))) for i in range(len(z))] for z in zip(*a)]))))
+    b = np.empty(shape=(len(y), 2), dtype=np.float32)
+    b[:,0] = np.repeat(x, nhits)
+    b[:,1] = y
 
     h, e = np.histogramdd(b, bins=bins)
 
-    # normalize within r bin... generalize me
-    h = np.apply_along_axis(lambda x: x/np.sum(x), 1, h)
+    # normalize within x bin (guarding against division by zero for empty
+    # x bins, which are then floored like any other empty bin below)
+    sums = h.sum(axis=1, keepdims=True)
+    sums[sums == 0] = 1
+    h /= sums
 
     # set zero-content bins to 0.1 * minimum nonzero bin
-    min_val = np.min(h[h > 0])
-    h[(h == 0)] = min_val / 10
+    nonzero = h > 0
+    min_val = np.min(h[nonzero]) if nonzero.any() else 1.0
+    h[~nonzero] = min_val / 10
+
+    if log:
+        np.log(h, out=h)
 
     return h, e
 
 
 if __name__ == '__main__':
-    import dataset
-    import glob
-
-    try:
-        d = dataset.load('tl208')
-    except IOError:
-        d = dataset.Dataset('tl208', filenames=glob.glob('/home/mastbaum/snoplus/tl208/data/pdf/tl208/run0/av_tl208-0.root'))
-
-    d.append(glob.glob('/home/mastbaum/snoplus/tl208/data/pdf/tl208/run1/av_tl208-*.root'))
-
-    cut = dataset.Cut(e=(2.555,2.718))
-    d.apply_cuts([cut])
+    import os
+    import h5py
+    import hdf5plugin  # registers the Blosc filter used for the pmt datasets
 
-    events = d.cut[cut.as_tuple()]['events']
+    h5file = h5py.File(os.path.expanduser('~/.lxid/lxid.hdf5'), 'r')
+    ds = h5file['tl208']
 
-    h, e = make_pdf(events, ['r', 'pmt_t_res'], (10, 500,))
+    h, e = make_pdf(ds['fit'][:,3], ds['pmt/tres'][:], ds['event_ptr'][:], (10, 500,))
 
     import matplotlib.pyplot as plt
     import matplotlib.cm as cm
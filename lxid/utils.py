@@ -1,8 +1,216 @@
 '''Various utilities'''
 
+# PMT charges are stored as int16, in units of 1/PMT_Q_SCALE
+PMT_Q_SCALE = 8.0
+
+# C++ helpers, compiled on first use by _cpp_helpers()
+_CPP_HELPERS = '''
+#include <vector>
+
+namespace lxid {
+
+// Copy the PMT ids, times, and charges out of an EV in a single pass
+void unpack_pmts(RAT::DS::EV* ev, std::vector<unsigned short>& id,
+                 std::vector<float>& t, std::vector<float>& q) {
+    size_t n = ev->GetPMTCalCount();
+    id.resize(n);
+    t.resize(n);
+    q.resize(n);
+    for (size_t i=0; i<n; i++) {
+        RAT::DS::PMTCal* pmt = ev->GetPMTCal(i);
+        id[i] = pmt->id;
+        t[i] = pmt->sPMTt;
+        q[i] = pmt->sQHS;
+    }
+}
+
+// Copy all PMT positions into a flat (x, y, z, x, y, z, ...) array
+void pmt_positions(RAT::DS::PMTProperties* prop, std::vector<float>& pos) {
+    size_t n = prop->GetPMTCount();
+    pos.resize(3 * n);
+    for (size_t i=0; i<n; i++) {
+        TVector3 p = prop->GetPos(i);
+        pos[3*i] = p.X();
+        pos[3*i+1] = p.Y();
+        pos[3*i+2] = p.Z();
+    }
+}
+
+}  // namespace lxid
+'''
+
+_helpers = None
+
+def _cpp_helpers():
+    '''Declare the C++ helpers to the ROOT interpreter (once per process).
+
+    :returns: The ROOT.lxid namespace
+    '''
+    global _helpers
+    if _helpers is None:
+        from rat import ROOT
+        ROOT.gInterpreter.Declare(_CPP_HELPERS)
+        _helpers = ROOT.lxid
+    return _helpers
+
+
+def _as_array(v, dtype):
+    '''Copy a std::vector into a new ndarray.'''
+    import numpy as np
+    n = v.size()
+    if n == 0:
+        return np.empty(0, dtype=dtype)
+    return np.frombuffer(v.data(), dtype=dtype, count=n).copy()
+
+
+_pmt_buffers = None
+
+def _unpack_pmts(ev):
+    '''Extract the calibrated PMT hits from an event.
+
+    The std::vectors the hits are unpacked into are reused between calls,
+    so only the returned copies are allocated per event.
+
+    :param ev: A RAT.DS.EV
+    :returns: (ids, t, q) tuple of ndarrays, one element per hit PMT
+    '''
+    import numpy as np
+
+    global _pmt_buffers
+    if _pmt_buffers is None:
+        from rat import ROOT
+        _pmt_buffers = (ROOT.std.vector('unsigned short')(),
+                        ROOT.std.vector('float')(),
+                        ROOT.std.vector('float')())
+
+    ids, t, q = _pmt_buffers
+    _cpp_helpers().unpack_pmts(ev, ids, t, q)
+
+    return _as_array(ids, np.uint16), _as_array(t, np.float32), _as_array(q, np.float32)
+
+
+def _pmt_positions(run):
+    '''Extract the positions of all PMTs in the detector.
+
+    :param run: A RAT.DS.Run
+    :returns: ndarray of shape (npmts, 3), indexed by PMT id
+    '''
+    from rat import ROOT
+    import numpy as np
+
+    pos = ROOT.std.vector('float')()
+    _cpp_helpers().pmt_positions(run.GetPMTProp(), pos)
+
+    return _as_array(pos, np.float32).reshape((-1, 3))
+
+
+_tres_kernel = None
+
+def _tres():
+    '''JIT-compile the time residual kernel (once per process).
+
+    The kernel treats the detector as concentric spheres: scintillator
+    inside the AV, the AV shell, then water out to the PMTs. For each hit,
+    the straight vertex-PMT path is split into its length in each medium
+    and converted to a time of flight.
+
+    Kernel arguments are (ids, t, vx, vy, vz, vt, pmt_pos, r_av_in, r_av_out,
+    t0, s_scint, s_av, s_water), where s_* are inverse group velocities
+    (ns/mm) and t0 is a constant offset; see _light_path.
+
+    :returns: The compiled kernel
+    '''
+    global _tres_kernel
+    if _tres_kernel is None:
+        from numba import njit
+        import numpy as np
+
+        @njit(fastmath=True)
+        def chord(vx, vy, vz, ux, uy, uz, length, radius):
+            '''Length of the segment inside a sphere centered on the origin.'''
+            b = vx * ux + vy * uy + vz * uz
+            c = vx * vx + vy * vy + vz * vz - radius * radius
+            disc = b * b - c
+            if disc <= 0:
+                return 0.0
+            root = np.sqrt(disc)
+            return max(0.0, min(-b + root, length) - max(-b - root, 0.0))
+
+        # serial: events have only hundreds of hits, and conversion is
+        # already parallelized across processes
+        @njit(fastmath=True)
+        def kernel(ids, t, vx, vy, vz, vt, pmt_pos, r_av_in, r_av_out, t0, s_scint, s_av, s_water):
+            tres = np.empty(len(ids), dtype=np.float32)
+            for i in range(len(ids)):
+                # numba does not bounds-check indexing
+                if ids[i] < 0 or ids[i] >= len(pmt_pos):
+                    raise IndexError('PMT id out of range')
+
+                dx = pmt_pos[ids[i], 0] - vx
+                dy = pmt_pos[ids[i], 1] - vy
+                dz = pmt_pos[ids[i], 2] - vz
+                length = np.sqrt(dx * dx + dy * dy + dz * dz)
+                ux, uy, uz = dx / length, dy / length, dz / length
+
+                d_inner = chord(vx, vy, vz, ux, uy, uz, length, r_av_in)
+                d_outer = chord(vx, vy, vz, ux, uy, uz, length, r_av_out)
+                tof = t0 + d_inner * s_scint + (d_outer - d_inner) * s_av + (length - d_outer) * s_water
+
+                tres[i] = t[i] - vt - tof
+            return tres
+
+        _tres_kernel = kernel
+    return _tres_kernel
+
+
+def _light_path(run):
+    '''Reduce a run's light path model to the parameters of _tres.
+
+    StraightLinePath and EffectiveVelocityTime are probed once: a path from
+    the center out past the PMTs gives the AV radii, and unit distances in
+    each medium give the inverse velocities.
+
+    :param run: A RAT.DS.Run
+    :returns: (r_av_in, r_av_out, t0, s_scint, s_av, s_water) tuple
+    '''
+    from rat import ROOT
+
+    dscint, dav, dwater = ROOT.Double(0), ROOT.Double(0), ROOT.Double(0)
+    origin = ROOT.TVector3(0, 0, 0)
+    outside = ROOT.TVector3(1e5, 0, 0)
+    run.GetStraightLinePath().CalcByPosition(origin, outside, dscint, dav, dwater)
+    r_av_in = float(dscint)
+    r_av_out = r_av_in + float(dav)
+
+    step = 1000.0  # mm
+    tof = run.GetEffectiveVelocityTime().CalcByDistance
+    t0 = tof(0.0, 0.0, 0.0)
+    s_scint = (tof(step, 0.0, 0.0) - t0) / step
+    s_av = (tof(0.0, step, 0.0) - t0) / step
+    s_water = (tof(0.0, 0.0, step) - t0) / step
+
+    return r_av_in, r_av_out, t0, s_scint, s_av, s_water
+
+
 def events_from_ds(filename, cut=None, fitter='scintFitter'):
     '''Convert a ROOT file to a numpy array format.
 
+    See events_from_chain for the format of the returned tuple.
+
+    :param filename: Name of ROOT file to extract
+    :param cut: *optional* Cut object to apply to data
+    :param fitter: Name of fit result to extract
+    :returns: (counters, fit, pmt_id, pmt_t, pmt_q, pmt_tres, event_ptr) tuple
+    '''
+    return events_from_chain([filename], cut, fitter)
+
+
+def events_from_chain(files, cut=None, fitter='scintFitter'):
+    '''Convert a set of ROOT files to a numpy array format.
+
+    The files are read as a single TChain, so the branch setup and cache
+    are shared. Detector geometry is taken from the first file.
+
     In the returned tuple:
 
         counters: dict with events_total, events_triggered,
@@ -10,16 +218,22 @@ def events_from_ds(filename, cut=None, fitter='scintFitter'):
 
         fit: ndarray of shape (nevents, 6), where columns are fit X Y Z R T E
 
-        pmt_t: ndarray of shape (nevents, 10000) with per-PMT hit times
+        pmt_id: uint16 ndarray of shape (nhits,) with the hit PMT ids
 
-        pmt_q: ndarray of shape (nevents, 10000) with per-PMT QHS charge
+        pmt_t: ndarray of shape (nhits,) with per-PMT hit times
 
-        pmt_tres: ndarray of shape (nevents, 10000) with PMT time residuals
+        pmt_q: int16 ndarray of shape (nhits,) with per-PMT QHS charge, in
+            units of 1/PMT_Q_SCALE
 
-    :param filename: Name of ROOT file to extract
+        pmt_tres: ndarray of shape (nhits,) with PMT time residuals
+
+        event_ptr: ndarray of shape (nevents+1,); the hits for event i are
+            pmt_*[event_ptr[i]:event_ptr[i+1]]
+
+    :param files: List of ROOT file names to extract
     :param cut: *optional* Cut object to apply to data
     :param fitter: Name of fit result to extract
-    :returns: (counters, fit, pmt_t, pmt_q) tuple
+    :returns: (counters, fit, pmt_id, pmt_t, pmt_q, pmt_tres, event_ptr) tuple
     '''
     from rat import dsreader, ROOT
     import numpy as np
@@ -32,27 +246,40 @@ def events_from_ds(filename, cut=None, fitter='scintFitter'):
     }
 
     tree = ROOT.TChain('T')
-    tree.Add(filename)
+    for filename in files:
+        tree.Add(filename)
 
     nevents = tree.GetEntries()
     ds = ROOT.RAT.DS.Root()
     tree.SetBranchAddress('ds', ds)
 
+    # skip the MC truth, which is large and unused here, and read the rest
+    # through a TTreeCache so baskets are fetched in a few large reads
+    for mc_branch in ('mc', 'ds.mc'):
+        if tree.GetBranch(mc_branch):
+            tree.SetBranchStatus(mc_branch + '*', 0)
+    tree.SetCacheSize(50 * 1024 * 1024)
+    tree.AddBranchToCache('ds', True)
+    tree.StopCacheLearningPhase()
+
     runtree = ROOT.TChain('runT')
-    runtree.Add(filename)
+    runtree.Add(files[0])
 
     run = ROOT.RAT.DS.Run()
     runtree.SetBranchAddress('run', run)
     runtree.GetEvent(0)
 
-    dscint, dav, dwater = ROOT.Double(0), ROOT.Double(0), ROOT.Double(0)
+    # detector geometry, fixed for the run
+    pmt_pos = _pmt_positions(run)
+    light_path = _light_path(run)
+    tres_kernel = _tres()
 
-    # allocate enough for all events, crop later
-    valid = np.zeros(shape=(nevents), dtype=np.bool)
-    fit = np.zeros(shape=(nevents, 6), dtype=np.float32)
-    pmt_t = np.zeros(shape=(nevents, 10000), dtype=np.float32)
-    pmt_q = np.zeros(shape=(nevents, 10000), dtype=np.float32)
-    pmt_tres = np.zeros(shape=(nevents, 10000), dtype=np.float32)
+    # per-event arrays, concatenated at the end
+    fit = []
+    pmt_id = []
+    pmt_t = []
+    pmt_q = []
+    pmt_tres = []
 
     for i in range(nevents):
         tree.GetEvent(i)
@@ -64,55 +291,67 @@ def events_from_ds(filename, cut=None, fitter='scintFitter'):
         counters['events_triggered'] += 1
 
         try:
-            if not ds.GetEV(0).GetFitResult(fitter).GetValid():
+            ev = ds.GetEV(0)
+            fit_result = ev.GetFitResult(fitter)
+            if not fit_result.GetValid():
                 continue
 
-            vertex = ds.GetEV(0).GetFitResult(fitter).GetVertex(0)
+            vertex = fit_result.GetVertex(0)
             pos = vertex.GetPosition()
-            this_fit = np.array([pos.X(), pos.Y(), pos.Z(), pos.Mag(), vertex.GetTime(), vertex.GetEnergy()], dtype=np.float32)
+            x, y, z, t = pos.X(), pos.Y(), pos.Z(), vertex.GetTime()
+            this_fit = (x, y, z, pos.Mag(), t, vertex.GetEnergy())
 
             counters['events_reconstructed'] += 1
 
             if cut is not None and not cut.apply(vertex):
                 continue
 
-            counters['events_pass'] += 1
-            fit[i] = this_fit
+        except Exception as e:
+            print 'warning: no fit %s available (%s)' % (fitter, e)
+            continue
 
-            for ipmt in range(ds.GetEV(0).GetPMTCalCount()):
-                pmt = ds.GetEV(0).GetPMTCal(ipmt)
-                pmt_t[i][pmt.id] = pmt.sPMTt
-                pmt_q[i][pmt.id] = pmt.sQHS
+        ids, ts, qs = _unpack_pmts(ev)
 
-                # time residuals
-                pmt_pos = run.GetPMTProp().GetPos(pmt.id)
-                run.GetStraightLinePath().CalcByPosition(vertex.GetPosition(), pmt_pos, dscint, dav, dwater)
-                tof = run.GetEffectiveVelocityTime().CalcByDistance(dscint, dav, dwater)
-                pmt_tres[i][pmt.id] = pmt.sPMTt - vertex.GetTime() - tof
+        tres = tres_kernel(ids, ts, x, y, z, t, pmt_pos, *light_path)
 
-            valid[i] = 1
+        fit.append(this_fit)
+        pmt_id.append(ids)
+        pmt_t.append(ts)
+        pmt_q.append(qs)
+        pmt_tres.append(tres)
 
-        except Exception as e:
-            print 'warning: no fit %s available (%s)' % (fitter, e)
-            continue
+        counters['events_pass'] += 1
+
+    nhits = np.array([len(ids) for ids in pmt_id], dtype=np.int64)
+    event_ptr = np.zeros(shape=(len(fit)+1), dtype=np.int64)
+    np.cumsum(nhits, out=event_ptr[1:])
+
+    fit = np.array(fit, dtype=np.float32).reshape((-1, 6))
+    pmt_id = np.concatenate(pmt_id + [np.empty(0, dtype=np.uint16)])
+    pmt_t = np.concatenate(pmt_t + [np.empty(0, dtype=np.float32)])
+    pmt_q = np.concatenate(pmt_q + [np.empty(0, dtype=np.float32)])
+    pmt_q = np.clip(np.round(pmt_q * PMT_Q_SCALE), -32768, 32767).astype(np.int16)
+    pmt_tres = np.concatenate(pmt_tres + [np.empty(0, dtype=np.float32)])
 
-    fit = fit[valid > 0]
-    pmt_t = pmt_t[valid > 0]
-    pmt_q = pmt_q[valid > 0]
-    pmt_tres = pmt_tres[valid > 0]
+    return counters, fit, pmt_id, pmt_t, pmt_q, pmt_tres, event_ptr
 
-    return counters, fit, pmt_t, pmt_q, pmt_tres
 
+def _batches(files, batch_size):
+    '''Split a list of files into lists of at most batch_size files.'''
+    return [files[i:i+batch_size] for i in range(0, len(files), batch_size)]
 
-def convert_events(files, cut=None, callback=None):
+
+def convert_events(files, cut=None, callback=None, batch_size=10):
     '''Read ROOT files and convert their events to a numpy array format.
 
-    This is done one file at a time -- SLOWLY. Consider using
+    This is done in this process, a batch of files (read as one chain) at
+    a time -- SLOWLY. Consider using convert_events_pool or
     convert_events_parallel.
 
     :param files: A list of ROOT file names
     :param cut: Cut to apply to events
-    :param callback: Called with each event
+    :param callback: Called with the events of each batch
+    :param batch_size: Number of files per batch
     :returns: Converted events if callback is not provided
     '''
     from lxid.dataset import Cut
@@ -125,9 +364,45 @@ def convert_events(files, cut=None, callback=None):
         results = []
         callback = results.append
 
-    for filename in files:
-        o = events_from_ds(filename, cut)
-        callback(o)
+    for batch in _batches(files, batch_size):
+        callback(events_from_chain(batch, cut))
+
+    return results
+
+
+def convert_events_pool(files, cut=None, callback=None, nproc=None, batch_size=10):
+    '''Read ROOT files and convert their events to a numpy array format.
+
+    This is done in parallel on the local machine. The files are split
+    into batches, each read as one chain, and results are streamed back
+    as batches finish.
+
+    :param files: A list of ROOT file names
+    :param cut: Cut to apply to events
+    :param callback: Called with the events of each batch
+    :param nproc: Number of processes (default: number of CPUs)
+    :param batch_size: Number of files per batch
+    :returns: Converted events if callback is not provided
+    '''
+    import functools
+    import multiprocessing
+    from lxid.dataset import Cut
+
+    if cut is None:
+        cut = Cut()
+
+    results = None
+    if callback is None:
+        results = []
+        callback = results.append
+
+    pool = multiprocessing.Pool(nproc)
+    try:
+        for o in pool.imap_unordered(functools.partial(events_from_chain, cut=cut), _batches(files, batch_size)):
+            callback(o)
+    finally:
+        pool.terminate()
+        pool.join()
 
     return results
 
@@ -144,7 +419,7 @@ def convert_events_parallel(files, cut=None, callback=None, context=None):
     :param context: A ZeroMQ context
     :returns: Converted events if callback is not provided
     '''
-    from lxid.parallel import Ventilator, Sink
+    from lxid.parallel import Ventilator, Sink, recv_arrays
     from lxid.dataset import Cut
     import zmq
 
@@ -177,12 +452,12 @@ def convert_events_parallel(files, cut=None, callback=None, context=None):
     # listen for processed events from the sink
     while True:
         try:
-            o = sink_data.recv_pyobj()
+            header, arrays = recv_arrays(sink_data)
         except Exception:
-            o = sink_data.recv_pyobj()
-        if o == None:
+            header, arrays = recv_arrays(sink_data)
+        if header is None:
             break
-        callback(o)
+        callback((header['counters'],) + tuple(arrays))
 
     v.join()
     s.join()
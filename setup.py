@@ -9,6 +9,6 @@ setup(
     url = 'http://github.com/mastbaum/lxid',
     packages = ['lxid'],
     scripts = ['bin/convert_events.py'],
-    install_requires = ['pyzmq-static']
+    install_requires = ['pyzmq-static', 'hdf5plugin', 'numba']
 )
 